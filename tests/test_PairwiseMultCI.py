@@ -8,6 +8,7 @@ from scipy import stats
 
 from tigramite.independence_tests.parcorr import ParCorr
 from tigramite.independence_tests.robust_parcorr import RobustParCorr
+from tigramite.independence_tests import pairwise_CI
 from tigramite.independence_tests.pairwise_CI import PairwiseMultCI
 from tigramite.independence_tests.cmiknn import CMIknn
 from tigramite.independence_tests.regressionCI import RegressionCI
@@ -96,3 +97,255 @@ def test_pairwise_mult_ci(pairwise_mult_ci, data_sample_c_cc_c):
     val = test_result[0]
     pval = test_result[1]
     np.testing.assert_allclose(pval, 0.5, atol=0.5)
+
+class ParCorrPerPair(ParCorr):
+    # Subclass of ParCorr that is not dispatched to the joint residual computation
+    pass
+
+def check_parcorr_fast_path(sig, x, y, z):
+    # The joint residual computation for ParCorr must agree with running the
+    # univariate tests one by one
+    results = []
+    for cond_ind_test in [ParCorr, ParCorrPerPair]:
+        if sig != "fixed_thres":
+            ci = PairwiseMultCI(cond_ind_test = cond_ind_test(significance = sig),
+                                alpha_pre = 0.5, pre_step_sample_fraction = 0.2)
+        else:
+            ci = PairwiseMultCI(cond_ind_test = cond_ind_test(significance = sig),
+                                alpha_pre = None, pre_step_sample_fraction = 0.2,
+                                significance = sig, fixed_thres_pre = 0.1)
+        results.append(ci.run_test_raw(x = x, y = y, z = z, alpha_or_thres = 0.1))
+    np.testing.assert_allclose(results[0][0], results[1][0], rtol=1e-7)
+    if sig != "fixed_thres":
+        np.testing.assert_allclose(results[0][1], results[1][1], rtol=1e-6)
+    assert results[0][2] == results[1][2]
+
+# The joint residual computation is done with numpy or, for at least _MIN_PAIRS_NUMBA
+# pairs, with the numba kernels
+@pytest.mark.parametrize("min_pairs_numba", [0, 10**6])
+@pytest.mark.parametrize("sig", ["analytic", "fixed_thres"])
+def test_pairwise_mult_ci_parcorr_fast_path(sig, min_pairs_numba, data_sample_c_cc_c, monkeypatch):
+    monkeypatch.setattr(pairwise_CI, "_MIN_PAIRS_NUMBA", min_pairs_numba)
+    x, y, z = data_sample_c_cc_c
+    check_parcorr_fast_path(sig, x, y, z)
+
+@pytest.mark.parametrize("min_pairs_numba", [0, 10**6])
+@pytest.mark.parametrize("sig", ["analytic", "fixed_thres"])
+@pytest.mark.parametrize("seed, dim_x, dim_y, dim_z, duplicate_z", [
+    (123, 3, 4, 2, False),
+    (46, 4, 3, 3, False),
+    # Rank-deficient Z, for which the residuals are not obtained from the normal equations
+    (46, 4, 3, 3, True),
+])
+def test_pairwise_mult_ci_parcorr_fast_path_mult(sig, seed, dim_x, dim_y, dim_z, duplicate_z,
+                                                 min_pairs_numba, monkeypatch):
+    monkeypatch.setattr(pairwise_CI, "_MIN_PAIRS_NUMBA", min_pairs_numba)
+    # Multivariate X, Y, Z with dependencies within X and within Y, such that
+    # the sets S_ij contain several components
+    np.random.seed(seed)
+    T = 500
+    z = np.random.normal(0, 1, (T, dim_z))
+    if duplicate_z:
+        z[:, 1] = z[:, 0]
+    x = np.random.normal(0, 1, (T, dim_x)) + z.sum(axis=1, keepdims=True)
+    x[:, 1:] += 0.8 * x[:, :1]
+    y = np.random.normal(0, 1, (T, dim_y)) + 0.3 * x[:, :1]
+    y[:, 1:] += 0.8 * y[:, :1]
+    check_parcorr_fast_path(sig, x, y, z)
+
+def test_pairwise_mult_ci_n_jobs(data_sample_c_cc_c):
+    # Running the univariate tests in parallel must not change the result
+    x, y, z = data_sample_c_cc_c
+    results = []
+    for n_jobs in [1, 2]:
+        ci = PairwiseMultCI(cond_ind_test = ParCorrPerPair(significance = "analytic"),
+                            alpha_pre = 0.5, pre_step_sample_fraction = 0.2, n_jobs = n_jobs)
+        results.append(ci.run_test_raw(x = x, y = y, z = z))
+    np.testing.assert_allclose(results[0], results[1])
+
+class RegressionCITypeCheck(RegressionCI):
+    # Checks that the data types passed on match the data of each univariate test
+    def get_dependence_measure(self, array, xyz, data_type):
+        assert data_type.shape == array.shape
+        return RegressionCI.get_dependence_measure(self, array, xyz, data_type)
+
+@pytest.mark.parametrize("alpha_pre", [0.5, 0.99])
+def test_pairwise_mult_ci_data_type(alpha_pre):
+    np.random.seed(42)
+    T = 300
+    x = np.random.binomial(3, 0.5, (T, 3)).astype(float)
+    x[:, 1] = (x[:, 0] + np.random.binomial(1, 0.3, T)) % 4
+    y = np.random.normal(0, 1, (T, 3)) + 0.3 * x[:, :1]
+    y[:, 1:] += y[:, :1]
+    z = np.random.normal(0, 1, (T, 1))
+    x_type = np.ones(x.shape, dtype='int')
+    y_type = np.zeros(y.shape, dtype='int')
+    z_type = np.zeros(z.shape, dtype='int')
+    results = []
+    for n_jobs in [1, 2]:
+        ci = PairwiseMultCI(cond_ind_test = RegressionCITypeCheck(significance = "analytic"),
+                            alpha_pre = alpha_pre, n_jobs = n_jobs)
+        results.append(ci.run_test_raw(x = x, y = y, z = z, x_type = x_type,
+                                       y_type = y_type, z_type = z_type))
+    np.testing.assert_allclose(results[0], results[1])
+
+@pytest.mark.parametrize("sig, alpha_or_thres", [("analytic", 0.05), ("analytic", 1e-10),
+                                                 ("fixed_thres", 0.1), ("fixed_thres", 0.9)])
+def test_pairwise_mult_ci_early_stop(sig, alpha_or_thres):
+    # Stopping the second step early must not change the test decision
+    np.random.seed(123)
+    T = 300
+    x = np.random.normal(0, 1, (T, 3))
+    y = np.random.normal(0, 1, (T, 3)) + 0.3 * x[:, :1]
+    z = np.random.normal(0, 1, (T, 1))
+    results = []
+    for early_stop in [False, True]:
+        if sig != "fixed_thres":
+            ci = PairwiseMultCI(cond_ind_test = ParCorrPerPair(significance = sig),
+                                alpha_pre = 0.5, early_stop = early_stop)
+        else:
+            ci = PairwiseMultCI(cond_ind_test = ParCorrPerPair(significance = sig),
+                                alpha_pre = None, significance = sig, fixed_thres_pre = 0.1,
+                                early_stop = early_stop)
+        results.append(ci.run_test_raw(x = x, y = y, z = z, alpha_or_thres = alpha_or_thres))
+    assert results[0][2] == results[1][2]
+    if not results[0][2]:
+        np.testing.assert_allclose(results[0][:2], results[1][:2])
+
+class CMIknnPerPair(CMIknn):
+    # Subclass of CMIknn that is not dispatched to the batched first step
+    pass
+
+@pytest.mark.parametrize("dim_z", [0, 2])
+def test_pairwise_mult_ci_cmiknn_batch(dim_z):
+    # The batched first step for CMIknn must agree with running the
+    # univariate tests one by one
+    np.random.seed(123)
+    T = 200
+    z = np.random.normal(0, 1, (T, dim_z))
+    x = np.random.normal(0, 1, (T, 2)) + z.sum(axis=1, keepdims=True)
+    y = np.random.normal(0, 1, (T, 3)) + 0.5 * x[:, :1]
+    results = []
+    for cond_ind_test in [CMIknn, CMIknnPerPair]:
+        ci = PairwiseMultCI(cond_ind_test = cond_ind_test(significance = "fixed_thres", seed = 42),
+                            alpha_pre = None, significance = "fixed_thres", fixed_thres_pre = 0.02)
+        results.append(ci.run_test_raw(x = x, y = y, z = z if dim_z > 0 else None, alpha_or_thres = 0.05))
+    np.testing.assert_allclose(results[0][0], results[1][0])
+    assert results[0][2] == results[1][2]
+
+class ParCorrCounting(ParCorr):
+    # Counts the univariate tests
+    n_tests = 0
+    def get_dependence_measure(self, array, xyz):
+        ParCorrCounting.n_tests += 1
+        return ParCorr.get_dependence_measure(self, array, xyz)
+
+def test_pairwise_mult_ci_pre_step_cache(data_sample_c_cc_c):
+    # A repeated test on the same data reuses the first step
+    x, y, z = data_sample_c_cc_c
+    ci = PairwiseMultCI(cond_ind_test = ParCorrCounting(significance = "analytic"),
+                        alpha_pre = 0.5, pre_step_sample_fraction = 0.2)
+    ParCorrCounting.n_tests = 0
+    result = ci.run_test_raw(x = x, y = y, z = z)
+    assert ParCorrCounting.n_tests == 2 * x.shape[1] * y.shape[1]
+    ParCorrCounting.n_tests = 0
+    np.testing.assert_allclose(ci.run_test_raw(x = x, y = y, z = z), result)
+    assert ParCorrCounting.n_tests == x.shape[1] * y.shape[1]
+    ci.reset_cache()
+    ParCorrCounting.n_tests = 0
+    np.testing.assert_allclose(ci.run_test_raw(x = x, y = y, z = z), result)
+    assert ParCorrCounting.n_tests == 2 * x.shape[1] * y.shape[1]
+
+def test_pairwise_mult_ci_store_full_stat_matrix(data_sample_c_cc_c):
+    # The kept matrices of the second step are consistent with the aggregated result
+    x, y, z = data_sample_c_cc_c
+    matrices = []
+    for cond_ind_test in [ParCorr, ParCorrPerPair]:
+        ci = PairwiseMultCI(cond_ind_test = cond_ind_test(significance = "analytic"),
+                            alpha_pre = 0.5, pre_step_sample_fraction = 0.2,
+                            store_full_stat_matrix = True)
+        val, pval = ci.run_test_raw(x = x, y = y, z = z)
+        assert ci.test_stats_main.shape == (x.shape[1], y.shape[1])
+        np.testing.assert_allclose(val, np.abs(ci.test_stats_main).max())
+        np.testing.assert_allclose(pval, min(ci.p_vals_main.min() * ci.p_vals_main.size, 1.))
+        matrices.append((ci.test_stats_main, ci.p_vals_main))
+    np.testing.assert_allclose(matrices[0][0], matrices[1][0], rtol=1e-7)
+    np.testing.assert_allclose(matrices[0][1], matrices[1][1], rtol=1e-6)
+
+@pytest.mark.parametrize("cond_ind_test", [ParCorr, ParCorrPerPair])
+def test_pairwise_mult_ci_hochberg(cond_ind_test, data_sample_c_cc_c):
+    # The Hochberg aggregation is the smallest adjusted p-value of the step-up
+    # procedure and never larger than the Bonferroni aggregation
+    x, y, z = data_sample_c_cc_c
+    pvals = {}
+    for aggregation_method in ['bonferroni', 'hochberg']:
+        ci = PairwiseMultCI(cond_ind_test = cond_ind_test(significance = "analytic"),
+                            alpha_pre = 0.5, pre_step_sample_fraction = 0.2,
+                            store_full_stat_matrix = True, aggregation_method = aggregation_method)
+        pvals[aggregation_method] = ci.run_test_raw(x = x, y = y, z = z)[1]
+    p_sorted = np.sort(ci.p_vals_main.ravel())
+    m = len(p_sorted)
+    adjusted = [min(min((m - k) * p_sorted[k] for k in range(i, m)), 1.) for i in range(m)]
+    np.testing.assert_allclose(pvals['hochberg'], min(adjusted))
+    assert pvals['hochberg'] <= pvals['bonferroni']
+
+class ParCorrRandomPValue(ParCorr):
+    # Returns a random draw as p-value of the shuffle test
+    def get_shuffle_significance(self, array, xyz, value, return_null_dist=False):
+        return self.random_state.random()
+
+def test_pairwise_mult_ci_n_jobs_random_state():
+    # The parallel shuffle tests must not all start from the same random state
+    np.random.seed(123)
+    T = 100
+    x = np.random.normal(0, 1, (T, 3))
+    y = np.random.normal(0, 1, (T, 3))
+    z = np.random.normal(0, 1, (T, 1))
+    ci = PairwiseMultCI(cond_ind_test = ParCorrRandomPValue(significance = "shuffle_test", seed = 42),
+                        alpha_pre = 0.5, n_jobs = 2, store_full_stat_matrix = True)
+    ci.run_test_raw(x = x, y = y, z = z)
+    assert len(np.unique(ci.p_vals_main)) == ci.p_vals_main.size
+
+def test_pairwise_mult_ci_early_stop_run_test_cache():
+    # Results of early stopped tests depend on alpha_or_thres, hence run_test must
+    # not reuse them for a different alpha_or_thres
+    from tigramite.data_processing import DataFrame
+    np.random.seed(42)
+    T = 500
+    data = np.random.normal(0, 1, (T, 5))
+    data[:, 3] += 0.3 * data[:, 0]
+    data[:, 4] += 0.5 * data[:, 1]
+    decisions = []
+    for early_stop in [False, True]:
+        ci = PairwiseMultCI(cond_ind_test = ParCorrPerPair(significance = "analytic"),
+                            alpha_pre = 0.5, early_stop = early_stop)
+        ci.set_dataframe(DataFrame(data))
+        decisions.append([ci.run_test(X = [(0, 0), (1, 0)], Y = [(3, 0), (4, 0)], Z = [(2, 0)],
+                                      alpha_or_thres = alpha)[2] for alpha in [0.5, 1e-4, 1e-12]])
+    assert decisions[0] == decisions[1]
+
+class ParCorrCountingOther(ParCorrCounting):
+    pass
+
+def test_pairwise_mult_ci_pre_step_cache_settings(data_sample_c_cc_c):
+    # The first step is not reused after the univariate test or its settings change,
+    # and run_test relies on the cache of CondIndTest instead
+    from tigramite.data_processing import DataFrame
+    x, y, z = data_sample_c_cc_c
+    m = x.shape[1] * y.shape[1]
+    ci = PairwiseMultCI(cond_ind_test = ParCorrCounting(significance = "analytic"),
+                        alpha_pre = 0.5, pre_step_sample_fraction = 0.2)
+    ci.run_test_raw(x = x, y = y, z = z)
+    ParCorrCounting.n_tests = 0
+    ci.cond_ind_test.sig_samples = 100
+    ci.run_test_raw(x = x, y = y, z = z)
+    assert ParCorrCounting.n_tests == 2 * m
+    ParCorrCounting.n_tests = 0
+    ci.cond_ind_test = ParCorrCountingOther(significance = "analytic", sig_samples = 100)
+    ci.run_test_raw(x = x, y = y, z = z)
+    assert ParCorrCounting.n_tests == 2 * m
+
+    ci.reset_cache()
+    ci.set_dataframe(DataFrame(np.hstack((x, y, z))))
+    ci.run_test(X = [(0, 0)], Y = [(1, 0), (2, 0)], Z = [(3, 0)])
+    assert len(ci._pre_cache) == 0
@@ -127,37 +127,20 @@ class CMIknn(CondIndTest):
                 print("knn = %s" % self.knn)
             print("shuffle_neighbors = %d\n" % self.shuffle_neighbors)
 
-    @jit(forceobj=True)
-    def _get_nearest_neighbors(self, array, xyz, knn):
-        """Returns nearest neighbors according to Frenzel and Pompe (2007).
-
-        Retrieves the distances eps to the k-th nearest neighbors for every
-        sample in joint space XYZ and returns the numbers of nearest neighbors
-        within eps in subspaces Z, XZ, YZ.
+    def _transform_array(self, array):
+        """Adds noise to destroy ties and transforms the array as given by
+        the transform parameter.
 
         Parameters
         ----------
         array : array-like
-            data array with X, Y, Z in rows and observations in columns
-
-        xyz : array of ints
-            XYZ identifier array of shape (dim,).
-
-        knn : int or float
-            Number of nearest-neighbors which determines the size of hyper-cubes
-            around each (high-dimensional) sample point. If smaller than 1, this
-            is computed as a fraction of T, hence knn=knn*T. For knn larger or
-            equal to 1, this is the absolute number.
+            data array with variables in rows and observations in columns
 
         Returns
         -------
-        k_xz, k_yz, k_z : tuple of arrays of shape (T,)
-            Nearest neighbors in subspaces.
+        array : array-like
+            Transformed array.
         """
-
-        array = array.astype(np.float64)
-        xyz = xyz.astype(np.int32)
-
         dim, T = array.shape
 
         # Add noise to destroy ties...
@@ -184,6 +167,43 @@ class CMIknn(CondIndTest):
         elif self.transform == 'ranks':
             array = array.argsort(axis=1).argsort(axis=1).astype(np.float64)
 
+        return array
+
+    @jit(forceobj=True)
+    def _get_nearest_neighbors(self, array, xyz, knn):
+        """Returns nearest neighbors according to Frenzel and Pompe (2007).
+
+        Retrieves the distances eps to the k-th nearest neighbors for every
+        sample in joint space XYZ and returns the numbers of nearest neighbors
+        within eps in subspaces Z, XZ, YZ.
+
+        Parameters
+        ----------
+        array : array-like
+            data array with X, Y, Z in rows and observations in columns
+
+        xyz : array of ints
+            XYZ identifier array of shape (dim,).
+
+        knn : int or float
+            Number of nearest-neighbors which determines the size of hyper-cubes
+            around each (high-dimensional) sample point. If smaller than 1, this
+            is computed as a fraction of T, hence knn=knn*T. For knn larger or
+            equal to 1, this is the absolute number.
+
+        Returns
+        -------
+        k_xz, k_yz, k_z : tuple of arrays of shape (T,)
+            Nearest neighbors in subspaces.
+        """
+
+        array = array.astype(np.float64)
+        xyz = xyz.astype(np.int32)
+
+        dim, T = array.shape
+
+        array = self._transform_array(array)
+
         array = array.T
         tree_xyz = spatial.cKDTree(array)
         epsarray = tree_xyz.query(array, k=[knn+1], p=np.inf,
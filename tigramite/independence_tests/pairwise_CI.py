@@ -5,13 +5,147 @@
 # License: GNU General Public License v3.0
 
 from __future__ import print_function
-from scipy import stats
+from scipy import stats, linalg, special, spatial
 import numpy as np
 import sys
 import warnings
+import copy
+from collections import defaultdict
+from hashlib import sha1
+from joblib import Parallel, delayed
+from numba import njit, prange
 
 from tigramite.independence_tests.independence_tests_base import CondIndTest
 from tigramite.independence_tests.parcorr import ParCorr
+from tigramite.independence_tests.robust_parcorr import RobustParCorr
+from tigramite.independence_tests.cmiknn import CMIknn
+
+# Maximum condition number of Z^T Z up to which residuals are obtained from the
+# normal equations instead of an orthogonal decomposition of Z
+_MAX_COND_NORMAL_EQUATIONS = 1e6
+
+# Machine precision, scaled by max(T, dim_z) as the relative cutoff for small singular
+# values of Z in least squares, as in np.linalg.lstsq with rcond=None
+_EPS = np.finfo(float).eps
+
+# Minimum number of pairs (j, jj) from which the tests of the ParCorr path are computed
+# by the numba kernels below. For smaller problems their one-time compilation is not
+# worthwhile and the tests are computed with numpy
+_MIN_PAIRS_NUMBA = 100
+
+@njit(parallel=True, cache=True)
+def _partial_corr_grid(X, Y, Z):
+    """Returns the partial correlations of all pairs of columns of X and Y given Z.
+
+    Parameters
+    ----------
+    X, Y, Z : arrays
+        Centered data arrays of shape (T, dim_x), (T, dim_y), and (T, dim_z).
+
+    Returns
+    -------
+    vals : array
+        Partial correlations of shape (dim_x, dim_y), nan for constant residuals.
+    """
+    dim_x = X.shape[1]
+    dim_y = Y.shape[1]
+    if Z.shape[1] > 0:
+        gram_z = np.dot(Z.T, Z)
+        if np.linalg.cond(gram_z) < _MAX_COND_NORMAL_EQUATIONS:
+            X = X - np.dot(Z, np.linalg.solve(gram_z, np.dot(Z.T, X)))
+            Y = Y - np.dot(Z, np.linalg.solve(gram_z, np.dot(Z.T, Y)))
+        else:
+            rcond = _EPS * max(Z.shape[0], Z.shape[1])
+            X = X - np.dot(Z, np.linalg.lstsq(Z, X, rcond=rcond)[0])
+            Y = Y - np.dot(Z, np.linalg.lstsq(Z, Y, rcond=rcond)[0])
+    # Components in contiguous rows
+    X = np.ascontiguousarray(X.T)
+    Y = np.ascontiguousarray(Y.T)
+    norm_x = np.sqrt((X * X).sum(axis=1))
+    norm_y = np.sqrt((Y * Y).sum(axis=1))
+    vals = np.empty((dim_x, dim_y))
+    for j in prange(dim_x):
+        for jj in range(dim_y):
+            denom = norm_x[j] * norm_y[jj]
+            if denom == 0.:
+                vals[j, jj] = np.nan
+            else:
+                vals[j, jj] = np.dot(X[j], Y[jj]) / denom
+    return vals
+
+
+@njit(parallel=True, cache=True)
+def _partial_corr_cond_grid(gram, dim_x, dim_y, cond_ptr, cond_indices):
+    """Returns the partial correlations of all pairs given their additional conditions.
+
+    The inner products of the residuals w.r.t. the conditions are obtained as the
+    Schur complement of the conditions in the Gram matrix, using a Cholesky
+    factorization of the Gram matrix of the conditions.
+
+    Parameters
+    ----------
+    gram : array
+        Inner products of the normalized residuals w.r.t. Z of all X and Y
+        components, of shape (dim_x + dim_y, dim_x + dim_y).
+
+    dim_x, dim_y : int
+        Dimensions of X and Y.
+
+    cond_ptr, cond_indices : arrays of ints
+        The conditions of pair (j, jj) are the components
+        cond_indices[cond_ptr[j*dim_y + jj]:cond_ptr[j*dim_y + jj + 1]].
+
+    Returns
+    -------
+    vals, ok : arrays
+        Partial correlations of shape (dim_x * dim_y,), and whether they could be
+        computed, i.e., the conditions and the residuals are not (nearly) collinear.
+    """
+    n_pairs = dim_x * dim_y
+    vals = np.zeros(n_pairs)
+    ok = np.ones(n_pairs, dtype=np.bool_)
+    for cell in prange(n_pairs):
+        a = cell // dim_y
+        b = dim_x + cell % dim_y
+        cond = cond_indices[cond_ptr[cell]:cond_ptr[cell + 1]]
+        k = cond.shape[0]
+        if k == 0:
+            vals[cell] = gram[a, b]
+            continue
+        # Cholesky factor of the Gram matrix of the conditions
+        chol = np.zeros((k, k))
+        for c in range(k):
+            diag = gram[cond[c], cond[c]] - np.dot(chol[c, :c], chol[c, :c])
+            if not diag > 1e-8:
+                ok[cell] = False
+                break
+            chol[c, c] = np.sqrt(diag)
+            for r in range(c + 1, k):
+                chol[r, c] = (gram[cond[r], cond[c]] - np.dot(chol[r, :c], chol[c, :c])) / chol[c, c]
+        if not ok[cell]:
+            continue
+        # Forward substitution for the inner products of the conditions with a and b
+        w_a = np.zeros(k)
+        w_b = np.zeros(k)
+        for r in range(k):
+            w_a[r] = (gram[cond[r], a] - np.dot(chol[r, :r], w_a[:r])) / chol[r, r]
+            w_b[r] = (gram[cond[r], b] - np.dot(chol[r, :r], w_b[:r])) / chol[r, r]
+        cov_aa = gram[a, a] - np.dot(w_a, w_a)
+        cov_bb = gram[b, b] - np.dot(w_b, w_b)
+        if not min(cov_aa, cov_bb) > 1e-8:
+            ok[cell] = False
+            continue
+        vals[cell] = (gram[a, b] - np.dot(w_a, w_b)) / np.sqrt(cov_aa * cov_bb)
+    return vals, ok
+
+
+def _run_test_raw_seeded(cond_ind_test, seed, x, y, z, **kwargs):
+    """Runs cond_ind_test.run_test_raw on a copy of cond_ind_test with a random state
+    seeded by seed, used for the parallel univariate tests."""
+    cond_ind_test = copy.copy(cond_ind_test)
+    cond_ind_test.random_state = np.random.default_rng(seed)
+    return cond_ind_test.run_test_raw(x, y, z, **kwargs)
+
 
 class PairwiseMultCI(CondIndTest):
     r""" Multivariate CI-test that aggregates univariate tests
@@ -24,8 +158,8 @@ class PairwiseMultCI(CondIndTest):
     - Step 2: On the second part of the sample, conditional independencies
       :math:`X_i \perp Y_j|(Z, S_{ij})` are tested, where the set :math:`S_{ij}` consists of components
       of :math:`X` that are independent of :math:`Y_j` given :math:`Z` (or components of :math:`Y` that
-      are independent of :math:`X_i` given :math:`Z`). Using the Bonferroni method, the univariate tests
-      are then aggregated.
+      are independent of :math:`X_i` given :math:`Z`). Using the Bonferroni method (or, optionally, the
+      Hochberg method), the univariate tests are then aggregated.
 
     The main reasoning behind this two-step procedure is that the conditional independence tests in the second step
     have larger effect sizes. One can show, that in cases where the within-:math:`X` or within-:math:`Y` dependence
@@ -36,6 +170,14 @@ class PairwiseMultCI(CondIndTest):
     - Tom Hochsprung, Jonas Wahl*, Andreas Gerhardus*, Urmi Ninad*, and Jakob Runge.
       Increasing Effect Sizes of Pairwise Conditional Independence Tests between Random Vectors. UAI2023, 2023.
 
+    Notes
+    -----
+    If cond_ind_test is ParCorr or RobustParCorr with significance "analytic" or "fixed_thres" (and no data_type is
+    given), the univariate tests are not run one by one. Instead, the residuals of all components of :math:`X` and
+    :math:`Y` w.r.t. :math:`Z` are computed jointly, and the partial correlations of the first step are obtained as
+    inner products of these residuals. In the second step, only the additional conditions :math:`S_{ij}` are
+    regressed out of the residuals.
+
     Parameters
     ----------
     alpha_pre: float
@@ -57,6 +199,37 @@ class PairwiseMultCI(CondIndTest):
         = "fixed_thres" (at least one such setting suffices), the pre_step works with a threshold instead of significance
         level
 
+    n_jobs : int, optional (default: 1)
+        Number of jobs to run the univariate tests of each step in parallel via
+        joblib (-1 uses all CPUs). Not used if the tests are computed jointly
+        from residuals (see Notes). Each parallel test then uses its own random state,
+        seeded from the one of cond_ind_test, such that the random draws of shuffle
+        tests differ from those of a serial run.
+
+    early_stop : bool, optional (default: False)
+        Whether to stop the second step as soon as the aggregated test is significant
+        at the alpha_or_thres passed to run_test or run_test_raw, i.e., once a p-value
+        is below alpha_or_thres / (dim_x * dim_y) or an absolute test statistic value
+        is above alpha_or_thres. The test decision is unchanged, but the returned test
+        statistic value and p-value then only aggregate the tests run so far (and
+        depend on alpha_or_thres, which is hence part of the key of the results
+        cached by run_test). Only used if n_jobs == 1 and the univariate tests
+        are run one by one.
+
+    store_full_stat_matrix : bool, optional (default: False)
+        Whether to keep the test statistic values and p-values of all univariate tests
+        of the second step of the last test as attributes test_stats_main and
+        p_vals_main, matrices of shape (dim_x, dim_y). Otherwise only their aggregates
+        are computed.
+
+    aggregation_method : {'bonferroni', 'hochberg'}, optional (default: 'bonferroni')
+        How the p-values of the univariate tests of the second step are aggregated. With
+        m = dim_x * dim_y tests and sorted p-values :math:`p_{(1)} \leq \ldots \leq p_{(m)}`,
+        'bonferroni' gives :math:`\min(m p_{(1)}, 1)` and 'hochberg' gives
+        :math:`\min_k \min((m - k + 1) p_{(k)}, 1)`, the smallest adjusted p-value of the
+        Hochberg step-up procedure. The latter is never larger, but only valid if the
+        univariate tests are independent or positively dependent. (Holm's method would
+        give the same aggregated p-value as Bonferroni's.)
 
     **kwargs :
         Arguments passed on to Parent class CondIndTest.
@@ -70,13 +243,30 @@ class PairwiseMultCI(CondIndTest):
         """
         return self._measure
 
-    def __init__(self, cond_ind_test = ParCorr(), alpha_pre = 0.5, pre_step_sample_fraction = 0.2, fixed_thres_pre = None, **kwargs):
+    def __init__(self, cond_ind_test = ParCorr(), alpha_pre = 0.5, pre_step_sample_fraction = 0.2, fixed_thres_pre = None,
+                 n_jobs = 1, early_stop = False, store_full_stat_matrix = False,
+                 aggregation_method = 'bonferroni', **kwargs):
         self._measure = 'pairwise_CI'
         self.cond_ind_test = cond_ind_test
         self.alpha_pre = alpha_pre
         self.pre_step_sample_fraction = pre_step_sample_fraction
         self.fixed_thres_pre = fixed_thres_pre
+        self.n_jobs = n_jobs
+        self.early_stop = early_stop
+        self.store_full_stat_matrix = store_full_stat_matrix
+        if aggregation_method not in ['bonferroni', 'hochberg']:
+            raise ValueError("aggregation_method must be 'bonferroni' or 'hochberg'.")
+        self.aggregation_method = aggregation_method
+        # alpha_or_thres of the current call of run_test or run_test_raw
+        self._alpha_or_thres = None
         self.two_sided = False
+        # Factorizations of the additional conditions S_ij in the second step,
+        # shared by all pairs (j, jj) with the same S_ij
+        self._cache = {}
+        # Results indep_set of the first step, keyed by the data of the first part of the
+        # sample, used within run_test_raw
+        self._pre_cache = {}
+        self._use_pre_cache = False
         CondIndTest.__init__(self, **kwargs)
 
 
@@ -99,6 +289,11 @@ class PairwiseMultCI(CondIndTest):
             to indicate whether variables are discrete (=1) or
             continuous (=0).
 
+        ci_test_thres : float, optional
+            Significance level or threshold of the aggregated test, used for early
+            stopping. Defaults to alpha_or_thres of the current call of run_test or
+            run_test_raw.
+
 
         Returns
         -------
@@ -117,18 +312,19 @@ class PairwiseMultCI(CondIndTest):
         if (fixed_thres_bool) and (self.fixed_thres_pre == None):
             raise ValueError("If significance == 'fixed_thres', fixed_thres_pre for the"
                              " pre-step needs to be defined in initializing PairwiseMultCI.")
+        if ci_test_thres is None:
+            ci_test_thres = self._alpha_or_thres
 
         x_indices = np.where(xyz == 0)[0]
         y_indices = np.where(xyz == 1)[0]
         z_indices = np.where(xyz == 2)[0]
 
-        dim_x = x_indices.shape[0]
-        dim_y = y_indices.shape[0]
+        dim_x = len(x_indices)
+        dim_y = len(y_indices)
         # what if unconditional test ...
-        dim_z = z_indices.shape[0]
+        dim_z = len(z_indices)
         T = array.shape[1]
-        size_first_block = np.floor(self.pre_step_sample_fraction * T)
-        size_first_block = size_first_block.astype(int)
+        size_first_block = int(self.pre_step_sample_fraction * T)
 
         # split the sample
         array_s1 = array[:, 0:size_first_block]
@@ -168,126 +364,703 @@ class PairwiseMultCI(CondIndTest):
             z_type_s1 = None
             z_type_s2 = None
 
-        ## Step 1: estimate conditional independencies
-        if fixed_thres_bool == False:
-            p_vals_pre = np.zeros((dim_x, dim_y))
+        parcorr_fast = self._use_parcorr_fast_path(data_type)
+        self._cache = {}
+
+        ## Step 1: estimate conditional independencies, unless already done on the same data.
+        # Under run_test, repeated tests are already caught by CondIndTest.cached_ci_results
+        if self._use_pre_cache:
+            pre_key = self._get_pre_step_key(array_s1, xyz, data_type, size_first_block, fixed_thres_bool)
+            indep_set = self._pre_cache.get(pre_key)
         else:
-            vals_pre = np.zeros((dim_x, dim_y))
-        for j in np.arange(0, dim_x):
-            for jj in np.arange(0, dim_y):
+            indep_set = None
+        if indep_set is None:
+            if parcorr_fast:
+                if dim_x * dim_y >= _MIN_PAIRS_NUMBA:
+                    vals_pre = _partial_corr_grid(*self._get_parcorr_centered(x_s1, y_s1, z_s1))
+                else:
+                    x_resid_s1, y_resid_s1 = self._get_parcorr_residuals(x_s1, y_s1, z_s1)
+                    vals_pre = np.dot(x_resid_s1.T, y_resid_s1)
                 if fixed_thres_bool == False:
-                    p_vals_pre[j, jj] = self.cond_ind_test.run_test_raw(x_s1[j].reshape(size_first_block, 1),
-                                                                   y_s1[jj].reshape(size_first_block, 1),
-                                                                   z_s1.reshape(size_first_block, dim_z),
-                                                                   x_type = x_type_s1,
-                                                                   y_type = y_type_s1,
-                                                                   z_type = z_type_s1)[1]
+                    p_vals_pre = self._get_parcorr_pvalues(vals_pre, size_first_block - 2 - dim_z)
+            elif self._use_cmiknn_batch(fixed_thres_bool, dim_x, dim_y):
+                vals_pre = self._get_cmiknn_pre_step(x_s1, y_s1, z_s1)
+            else:
+                # Observations in rows as expected by run_test_raw, transposed only once
+                x1, y1, z1 = x_s1.T, y_s1.T, z_s1.T
+                pre_tests = ((x1[:, j:j+1], y1[:, jj:jj+1], z1,
+                              self._get_type_column(x_type_s1, j), self._get_type_column(y_type_s1, jj), z_type_s1)
+                             for j in range(dim_x) for jj in range(dim_y))
+                vals_pre, p_vals_pre = self._run_tests(pre_tests, fixed_thres_bool)
+                vals_pre = vals_pre.reshape(dim_x, dim_y)
+                if fixed_thres_bool == False:
+                    p_vals_pre = p_vals_pre.reshape(dim_x, dim_y)
+            if fixed_thres_bool == False:
+                indep_set = np.where(p_vals_pre > self.alpha_pre)
+            else:
+                indep_set = np.where(np.abs(vals_pre) >= self.fixed_thres_pre)
+            if self._use_pre_cache:
+                self._store_pre_step(pre_key, indep_set)
+
+        # Step 2: test conditional independencies with increased effect sizes. Only the
+        # maximum absolute test statistic value and the minimum p-value are aggregated
+        if parcorr_fast:
+            # Residuals of X and Y components in columns 0, ..., dim_x - 1 and
+            # dim_x, ..., dim_x + dim_y - 1, and their inner products
+            resid_s2 = np.hstack(self._get_parcorr_residuals(x_s2, y_s2, z_s2))
+            gram_s2 = np.dot(resid_s2.T, resid_s2)
+            # Additional conditions of all pairs in compressed form, the conditions of
+            # pair (j, jj) are cond_indices[cond_ptr[j*dim_y + jj]:cond_ptr[j*dim_y + jj + 1]]
+            cond_list = []
+            for j, jj, indicesX, indicesY in self._get_conditions(dim_x, dim_y, indep_set):
+                if (len(indicesX) > len(indicesY)):
+                    cond_list.append(indicesX)
                 else:
-                    vals_pre[j, jj] = self.cond_ind_test.run_test_raw(x_s1[j].reshape(size_first_block, 1),
-                                                                   y_s1[jj].reshape(size_first_block, 1),
-                                                                   z_s1.reshape(size_first_block, dim_z),
-                                                                   x_type = x_type_s1,
-                                                                   y_type = y_type_s1,
-                                                                   z_type = z_type_s1,
-                                                                   alpha_or_thres=999.)[0] # just a dummy
-        if fixed_thres_bool == False:
-            indep_set = np.where(p_vals_pre > self.alpha_pre)
+                    cond_list.append(dim_x + indicesY)
+            cond_ptr = np.zeros(dim_x * dim_y + 1, dtype=np.intp)
+            cond_ptr[1:] = np.cumsum([len(cond) for cond in cond_list])
+            cond_indices = np.concatenate(cond_list)
+            if dim_x * dim_y >= _MIN_PAIRS_NUMBA:
+                vals_main, ok = _partial_corr_cond_grid(gram_s2, dim_x, dim_y, cond_ptr, cond_indices)
+            else:
+                vals_main = np.zeros(dim_x * dim_y)
+                ok = np.zeros(dim_x * dim_y, dtype='bool')
+            # Pairs with (nearly) collinear or constant components (or all pairs of small
+            # problems) are computed with the cached factorizations
+            for cell in np.flatnonzero(~ok):
+                j, jj = divmod(int(cell), dim_y)
+                vals_main[cell] = self._get_parcorr_main(resid_s2, gram_s2, j, dim_x + jj, cond_list[cell])
+            deg_f_main = T - size_first_block - (2 + dim_z + np.diff(cond_ptr))
+            pvals_main = None
+            if fixed_thres_bool == False:
+                if self.store_full_stat_matrix or self.aggregation_method == 'hochberg':
+                    pvals_main = self._get_parcorr_pvalues(vals_main, deg_f_main)
+                    p_min = np.min(pvals_main)
+                else:
+                    p_min = self._get_parcorr_min_pvalue(vals_main, deg_f_main)
         else:
-            indep_set = np.where(np.abs(vals_pre) >= self.fixed_thres_pre)
+            main_tests = self._get_main_tests(dim_x, dim_y, indep_set, x_s2.T, y_s2.T, z_s2.T,
+                                              x_type_s2, y_type_s2, z_type_s2)
+            if not self.early_stop or ci_test_thres is None:
+                stop_thres = None
+            elif fixed_thres_bool:
+                stop_thres = ci_test_thres
+            else:
+                stop_thres = ci_test_thres / (dim_x * dim_y)
+            vals_main, pvals_main = self._run_tests(main_tests, fixed_thres_bool, stop_thres)
+            if fixed_thres_bool == False:
+                p_min = np.min(pvals_main)
+
+        if self.store_full_stat_matrix:
+            self.test_stats_main = self._get_stat_matrix(vals_main, dim_x, dim_y)
+            self.p_vals_main = self._get_stat_matrix(pvals_main, dim_x, dim_y)
 
-        # Step 2: test conditional independencies with increased effect sizes
+        # Aggregate p-values
+        test_stats_aggregated = np.max(np.abs(vals_main))
         if self.cond_ind_test.significance != "fixed_thres":
-            p_vals_main = np.zeros((dim_x, dim_y))
+            if self.aggregation_method == 'hochberg':
+                p_aggregated = self._get_hochberg_pvalue(pvals_main, dim_x * dim_y)
+            else:
+                p_aggregated = np.min(np.array([p_min * dim_x * dim_y, 1]))
         else:
-            dependent_main = np.zeros((dim_x, dim_y))
-        test_stats_main = np.zeros((dim_x, dim_y))
-
-        for j in np.arange(0, dim_x):
-            for jj in np.arange(0, dim_y):
-                indicesY = np.zeros(0)
-                indicesX = np.zeros(0)
-
-                if (j in indep_set[0]):
-                    indicesX_locs = np.where(indep_set[0] == j)
-                    indicesY = np.setdiff1d(indep_set[1][indicesX_locs], jj)
-                if (jj in indep_set[1]):
-                    indicesY_locs = np.where(indep_set[1] == jj)
-                    indicesX = np.setdiff1d(indep_set[0][indicesY_locs], j)
-                lix = indicesX.shape[0]
-                liy = indicesY.shape[0]
-                if lix + liy > 0:
-                    if (lix > liy):
-                        if x_type_s2 is not None:
-                            z_type = np.hstack((z_type_s2, x_type_s2[:, indicesX]))
-                        if fixed_thres_bool == False:
-                            test_result = self.cond_ind_test.run_test_raw(x_s2[j].reshape(T - size_first_block, 1),
-                                                        y_s2[jj].reshape(T - size_first_block, 1),
-                                                        np.hstack((z_s2.reshape(T - size_first_block, dim_z),
-                                                                    x_s2[indicesX].reshape(T - size_first_block, lix))),
-                                                        x_type = x_type_s2,
-                                                        y_type = y_type_s2,
-                                                        z_type = z_type_s2)
-                        else:
-                            test_result = self.cond_ind_test.run_test_raw(x_s2[j].reshape(T - size_first_block, 1),
-                                                        y_s2[jj].reshape(T - size_first_block, 1),
-                                                        np.hstack((z_s2.reshape(T - size_first_block, dim_z),
-                                                                    x_s2[indicesX].reshape(T - size_first_block, lix))),
-                                                        x_type = x_type_s2,
-                                                        y_type = y_type_s2,
-                                                        z_type = z_type_s2,
-                                                        alpha_or_thres=999.) # just a dummy
-                    elif (lix <= liy):
-                        if y_type_s2 is not None:
-                            z_type_s2 = np.hstack((z_type_s2, y_type_s2[:, indicesY]))
-                        if fixed_thres_bool == False:
-                            test_result = self.cond_ind_test.run_test_raw(x_s2[j].reshape(T - size_first_block, 1),
-                                                        y_s2[jj].reshape(T - size_first_block, 1),
-                                                        np.hstack((z_s2.reshape(T - size_first_block, dim_z),
-                                                                    y_s2[indicesY].reshape(T - size_first_block, liy))),
-                                                        x_type = x_type_s2,
-                                                        y_type = y_type_s2,
-                                                        z_type = z_type_s2)
-                        else:
-                            test_result = self.cond_ind_test.run_test_raw(x_s2[j].reshape(T - size_first_block, 1),
-                                                        y_s2[jj].reshape(T - size_first_block, 1),
-                                                        np.hstack((z_s2.reshape(T - size_first_block, dim_z),
-                                                                    y_s2[indicesY].reshape(T - size_first_block, liy))),
-                                                        x_type = x_type_s2,
-                                                        y_type = y_type_s2,
-                                                        z_type = z_type_s2,
-                                                        alpha_or_thres=999.) # just a dummy
+            p_aggregated = None
+
+        return test_stats_aggregated, p_aggregated
+
+
+    def _get_conditions(self, dim_x, dim_y, indep_set):
+        """Yields the additional conditions of all tests of the second step.
+
+        Parameters
+        ----------
+        dim_x, dim_y : int
+            Dimensions of X and Y.
+
+        indep_set : tuple of arrays
+            Indices (j, jj) of the pairs found independent in the first step.
+
+        Yields
+        ------
+        j, jj, indicesX, indicesY : int, int, array, array
+            Tested pair and the components of X (or Y) that are independent of
+            Y_jj (or X_j) given Z.
+        """
+        # Adjacency lists of indep_set, built once instead of scanning indep_set for every pair
+        indepX = defaultdict(list)
+        indepY = defaultdict(list)
+        for a, b in zip(indep_set[0].tolist(), indep_set[1].tolist()):
+            indepX[a].append(b)
+            indepY[b].append(a)
+
+        for j in range(dim_x):
+            for jj in range(dim_y):
+                indicesY = np.fromiter((b for b in indepX[j] if b != jj), dtype=np.intp)
+                indicesX = np.fromiter((a for a in indepY[jj] if a != j), dtype=np.intp)
+                yield j, jj, indicesX, indicesY
+
+    def _get_pre_step_key(self, array_s1, xyz, data_type, size_first_block, fixed_thres_bool):
+        """Returns the key of the first step in the cache of its results.
+
+        Parameters
+        ----------
+        array_s1 : array
+            First part of the sample with X, Y, Z in rows.
+
+        xyz : array of ints
+            XYZ identifier array of shape (dim,).
+
+        data_type : array or None
+            Data types of the whole sample.
 
+        size_first_block : int
+            Size of the first part of the sample.
+
+        fixed_thres_bool : bool
+            Whether the tests are run with a fixed threshold.
+
+        Returns
+        -------
+        key : tuple
+            Hashes of the data and the settings that determine indep_set, including
+            the type and the scalar attributes (such as significance or knn) of
+            cond_ind_test.
+        """
+        test_settings = tuple(sorted((name, value) for name, value in vars(self.cond_ind_test).items()
+                                     if isinstance(value, (bool, int, float, str, type(None)))))
+        data_hash = sha1(np.ascontiguousarray(array_s1)).hexdigest()
+        if data_type is not None:
+            type_hash = sha1(np.ascontiguousarray(data_type[:, :size_first_block])).hexdigest()
+        else:
+            type_hash = None
+        return (data_hash, type_hash, array_s1.shape, xyz.tobytes(),
+                fixed_thres_bool, self.alpha_pre, self.fixed_thres_pre,
+                type(self.cond_ind_test), test_settings)
+
+    def _store_pre_step(self, key, indep_set):
+        """Stores the result of the first step, dropping the oldest entry if the
+        cache holds more than 1024 results."""
+        if len(self._pre_cache) >= 1024:
+            del self._pre_cache[next(iter(self._pre_cache))]
+        self._pre_cache[key] = indep_set
+
+    def reset_cache(self):
+        """Clears the cached results of the first step."""
+        self._pre_cache = {}
+
+    def _get_stat_matrix(self, vals, dim_x, dim_y):
+        """Returns the test statistic values or p-values of the second step as a matrix.
+
+        Parameters
+        ----------
+        vals : array or None
+            Values of the pairs (j, jj) in row-major order, possibly only of the
+            first pairs if the second step was stopped early.
+
+        dim_x, dim_y : int
+            Dimensions of X and Y.
+
+        Returns
+        -------
+        matrix : array or None
+            Matrix of shape (dim_x, dim_y), nan for pairs that were not tested.
+        """
+        if vals is None:
+            return None
+        matrix = np.full(dim_x * dim_y, np.nan)
+        matrix[:len(vals)] = vals
+        return matrix.reshape(dim_x, dim_y)
+
+    def _get_hochberg_pvalue(self, pvals, m):
+        """Returns the smallest adjusted p-value of the Hochberg step-up procedure.
+
+        Parameters
+        ----------
+        pvals : array
+            P-values of the univariate tests, possibly only of the first tests if
+            the second step was stopped early. The missing p-values are taken as 1.
+
+        m : int
+            Number of univariate tests.
+
+        Returns
+        -------
+        pval : float or numpy.nan
+            Aggregated p-value, nan if any p-value is nan.
+        """
+        p_sorted = np.sort(pvals)
+        factors = m - np.arange(len(p_sorted))
+        return np.min(np.append(factors * p_sorted, 1.))
+
+    def _get_main_tests(self, dim_x, dim_y, indep_set, x2, y2, z2, x_type_s2, y_type_s2, z_type_s2):
+        """Yields the input arrays of all univariate tests of the second step.
+
+        Parameters
+        ----------
+        dim_x, dim_y : int
+            Dimensions of X and Y.
+
+        indep_set : tuple of arrays
+            Indices (j, jj) of the pairs found independent in the first step.
+
+        x2, y2, z2 : arrays
+            Second part of the sample of X, Y, Z with observations in rows.
+
+        x_type_s2, y_type_s2, z_type_s2 : arrays or None
+            Data types of the second part of the sample with variables in columns.
+
+        Yields
+        ------
+        x, y, z, x_type, y_type, z_type : arrays
+            Arguments of run_test_raw of the univariate test. If n_jobs == 1, z and
+            z_type are views of buffers that are overwritten by the next test.
+        """
+        T, dim_z = z2.shape
+        if self.n_jobs == 1:
+            # run_test_raw copies its inputs, hence the conditions of all tests and their
+            # data types can be assembled in the same buffers. Components are stored in
+            # rows such that np.take writes into contiguous blocks without a temporary
+            cond = np.empty((dim_z + max(dim_x, dim_y), T))
+            cond[:dim_z] = z2.T
+            if z_type_s2 is not None:
+                cond_type = np.empty((dim_z + max(dim_x, dim_y), T), dtype=z_type_s2.dtype)
+                cond_type[:dim_z] = z_type_s2.T
+        for j, jj, indicesX, indicesY in self._get_conditions(dim_x, dim_y, indep_set):
+            lix = len(indicesX)
+            liy = len(indicesY)
+            # The conditions and their data types are local to the pair (j, jj)
+            z, z_type = z2, z_type_s2
+            if lix + liy > 0:
+                if (lix > liy):
+                    cond_vals, cond_var_type, cond_indices = x2, x_type_s2, indicesX
                 else:
-                    if fixed_thres_bool == False:
-                        test_result = self.cond_ind_test.run_test_raw(x_s2[j].reshape(T - size_first_block, 1),
-                                                                      y_s2[jj].reshape(T - size_first_block, 1),
-                                                                      z_s2.reshape(T - size_first_block, dim_z),
-                                                                      x_type = x_type_s2,
-                                                                      y_type = y_type_s2,
-                                                                      z_type = z_type_s2)
-                    else:
-                        test_result = self.cond_ind_test.run_test_raw(x_s2[j].reshape(T - size_first_block, 1),
-                                                                      y_s2[jj].reshape(T - size_first_block, 1),
-                                                                      z_s2.reshape(T - size_first_block, dim_z),
-                                                                      x_type = x_type_s2,
-                                                                      y_type = y_type_s2,
-                                                                      z_type = z_type_s2,
-                                                                      alpha_or_thres=999.) # just a dummy
-                
-                test_stats_main[j, jj] = test_result[0]
-                if fixed_thres_bool == False:
-                    p_vals_main[j, jj] = test_result[1]
+                    cond_vals, cond_var_type, cond_indices = y2, y_type_s2, indicesY
+                dim_cond = len(cond_indices)
+                if self.n_jobs == 1:
+                    # The indices are valid, mode='clip' avoids buffering the output
+                    np.take(cond_vals.T, cond_indices, axis=0, out=cond[dim_z:dim_z + dim_cond], mode='clip')
+                    z = cond[:dim_z + dim_cond].T
+                    if z_type_s2 is not None:
+                        np.take(cond_var_type.T, cond_indices, axis=0,
+                                out=cond_type[dim_z:dim_z + dim_cond], mode='clip')
+                        z_type = cond_type[:dim_z + dim_cond].T
+                else:
+                    z = np.hstack((z2, cond_vals[:, cond_indices]))
+                    if z_type_s2 is not None:
+                        z_type = np.hstack((z_type_s2, cond_var_type[:, cond_indices]))
+            yield (x2[:, j:j+1], y2[:, jj:jj+1], z,
+                   self._get_type_column(x_type_s2, j), self._get_type_column(y_type_s2, jj), z_type)
 
+    def _get_type_column(self, var_type, j):
+        """Returns the data type of component j, or None if no data types are given."""
+        if var_type is None:
+            return None
+        return var_type[:, j:j+1]
 
-        # Aggregate p-values
-        test_stats_aggregated = np.max(np.abs(test_stats_main))
-        if self.cond_ind_test.significance != "fixed_thres":
-            p_aggregated = np.min(np.array([np.min(p_vals_main) * dim_x * dim_y, 1]))
+    def _run_tests(self, tests, fixed_thres_bool, stop_thres=None):
+        """Runs univariate tests, in parallel if n_jobs != 1.
+
+        Parameters
+        ----------
+        tests : iterable
+            Arguments (x, y, z, x_type, y_type, z_type) of run_test_raw.
+
+        fixed_thres_bool : bool
+            Whether the tests are run with a fixed threshold.
+
+        stop_thres : float, optional
+            If given and n_jobs == 1, no further tests are run once a p-value is
+            at most (or, if fixed_thres_bool, an absolute test statistic value is
+            at least) stop_thres.
+
+        Returns
+        -------
+        vals, pvals : arrays
+            Test statistic values and p-values (None if fixed_thres_bool) of the
+            tests that were run.
+        """
+        if fixed_thres_bool:
+            kwargs = {'alpha_or_thres': 999.}  # just a dummy
         else:
-            p_aggregated = None
+            kwargs = {}
 
-        return test_stats_aggregated, p_aggregated
+        if self.n_jobs == 1:
+            results = []
+            for (x, y, z, x_type, y_type, z_type) in tests:
+                results.append(self.cond_ind_test.run_test_raw(x, y, z, x_type = x_type, y_type = y_type,
+                                                               z_type = z_type, **kwargs))
+                if stop_thres is not None:
+                    if fixed_thres_bool and np.abs(results[-1][0]) >= stop_thres:
+                        break
+                    if not fixed_thres_bool and results[-1][1] <= stop_thres:
+                        break
+        else:
+            # The kd-tree queries of CMIknn release the GIL
+            if isinstance(self.cond_ind_test, CMIknn):
+                backend = 'threading'
+            else:
+                backend = 'loky'
+            # Each test gets its own random state, seeded from the one of cond_ind_test,
+            # otherwise all tests would draw the same shuffles
+            results = Parallel(n_jobs=self.n_jobs, backend=backend, batch_size='auto')(
+                delayed(_run_test_raw_seeded)(self.cond_ind_test, self.cond_ind_test.random_state.integers(2**32),
+                                              x, y, z, x_type = x_type, y_type = y_type, z_type = z_type,
+                                              **kwargs)
+                for (x, y, z, x_type, y_type, z_type) in tests)
+
+        vals = np.array([result[0] for result in results])
+        if fixed_thres_bool:
+            return vals, None
+        return vals, np.array([result[1] for result in results])
+
+    def _use_parcorr_fast_path(self, data_type):
+        """Returns whether the univariate tests can be computed jointly from residuals.
 
+        This is the case for ParCorr and RobustParCorr (but not for subclasses, which may
+        change the dependence measure) with analytic significance or a fixed threshold.
+        """
+        return (data_type is None
+                and type(self.cond_ind_test) in (ParCorr, RobustParCorr)
+                and self.cond_ind_test.significance in ("analytic", "fixed_thres"))
+
+    def _use_cmiknn_batch(self, fixed_thres_bool, dim_x, dim_y):
+        """Returns whether the CMIknn tests of the first step are computed in one batch.
+
+        This is the case for CMIknn (but not for subclasses) with a fixed threshold,
+        where no shuffle tests are needed, and at least four pairs.
+        """
+        return (type(self.cond_ind_test) is CMIknn
+                and fixed_thres_bool
+                and dim_x * dim_y >= 4)
+
+    def _get_cmiknn_pre_step(self, x, y, z):
+        """Returns the CMIknn estimates of all pairs of components of x and y given z.
+
+        The estimates are those of CMIknn.get_dependence_measure, but the noise and
+        transformation of the data, the tree of the Z-subspace, and the trees of the
+        XZ- and YZ-subspaces of each component are computed only once. Only the tree
+        of the joint space, which determines the distances to the k-th nearest
+        neighbors, is specific to each pair.
+
+        Parameters
+        ----------
+        x, y, z : arrays
+            Data arrays of shape (dim_x, T), (dim_y, T), and (dim_z, T).
+
+        Returns
+        -------
+        vals : array
+            Conditional mutual information estimates of shape (dim_x, dim_y).
+        """
+        cmi = self.cond_ind_test
+        dim_x, dim_y = x.shape[0], y.shape[0]
+        array = np.vstack((x, y, z)).astype(np.float64)
+        T = array.shape[1]
+        if cmi.knn < 1:
+            knn_here = max(1, int(cmi.knn*T))
+        else:
+            knn_here = max(1, int(cmi.knn))
+
+        array = cmi._transform_array(array).T
+        z = array[:, dim_x + dim_y:]
+        if z.shape[1] > 0:
+            tree_z = spatial.cKDTree(z)
+        xz = [np.hstack((array[:, j:j+1], z)) for j in range(dim_x)]
+        yz = [np.hstack((array[:, dim_x + jj:dim_x + jj + 1], z)) for jj in range(dim_y)]
+        trees_xz = [spatial.cKDTree(vals) for vals in xz]
+        trees_yz = [spatial.cKDTree(vals) for vals in yz]
+
+        vals = np.zeros((dim_x, dim_y))
+        for j in range(dim_x):
+            for jj in range(dim_y):
+                xyz_vals = np.hstack((array[:, [j, dim_x + jj]], z))
+                epsarray = spatial.cKDTree(xyz_vals).query(xyz_vals, k=[knn_here+1], p=np.inf,
+                                    eps=0., workers=cmi.workers)[0][:, 0].astype(np.float64)
+                epsarray = np.multiply(epsarray, 0.99999)
+                k_xz = trees_xz[j].query_ball_point(xz[j], r=epsarray, eps=0., p=np.inf,
+                                                    workers=cmi.workers, return_length=True)
+                k_yz = trees_yz[jj].query_ball_point(yz[jj], r=epsarray, eps=0., p=np.inf,
+                                                     workers=cmi.workers, return_length=True)
+                if z.shape[1] > 0:
+                    k_z = tree_z.query_ball_point(z, r=epsarray, eps=0., p=np.inf,
+                                                  workers=cmi.workers, return_length=True)
+                else:
+                    k_z = np.full(T, T, dtype=np.float64)
+                vals[j, jj] = special.digamma(knn_here) - (special.digamma(k_xz) +
+                                                           special.digamma(k_yz) -
+                                                           special.digamma(k_z)).mean()
+        return vals
+
+    def _get_parcorr_centered(self, x, y, z):
+        """Returns the centered data of x, y, z, transformed to normal marginals
+        for RobustParCorr.
+
+        Parameters
+        ----------
+        x, y, z : arrays
+            Data arrays of shape (dim_x, T), (dim_y, T), and (dim_z, T).
+
+        Returns
+        -------
+        x_vals, y_vals, z_vals : arrays
+            C-contiguous arrays of shape (T, dim_x), (T, dim_y), and (T, dim_z).
+        """
+        dim_x, dim_y = x.shape[0], y.shape[0]
+        array = np.vstack((x, y, z))
+        if type(self.cond_ind_test) is RobustParCorr:
+            array = self.cond_ind_test.trafo2normal(array)
+        array = np.ascontiguousarray((array - array.mean(axis=1).reshape(array.shape[0], 1)).T)
+        return (np.ascontiguousarray(array[:, :dim_x]),
+                np.ascontiguousarray(array[:, dim_x:dim_x + dim_y]),
+                np.ascontiguousarray(array[:, dim_x + dim_y:]))
+
+    def _get_parcorr_residuals(self, x, y, z):
+        """Returns normalized residuals of all components of x and y after regressing out z.
+
+        Mirrors the preprocessing of ParCorr and RobustParCorr, i.e., a transformation
+        to normal marginals (RobustParCorr only), centering, and OLS regression on z.
+        The residuals are scaled to unit norm, such that their inner products are
+        partial correlations.
+
+        Parameters
+        ----------
+        x, y, z : arrays
+            Data arrays of shape (dim_x, T), (dim_y, T), and (dim_z, T).
+
+        Returns
+        -------
+        x_resid, y_resid : arrays
+            Normalized residuals of shape (T, dim_x) and (T, dim_y).
+        """
+        dim_x = x.shape[0]
+        x_vals, y_vals, z_vals = self._get_parcorr_centered(x, y, z)
+
+        resid = np.hstack((x_vals, y_vals))
+        if z.shape[0] > 0:
+            resid = resid - np.dot(z_vals, self._get_regression_coefficients(z_vals, resid))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            resid = resid / np.linalg.norm(resid, axis=0)
+
+        return resid[:, :dim_x], resid[:, dim_x:]
+
+    def _get_regression_coefficients(self, z, vals):
+        """Returns the OLS coefficients of regressing the columns of vals on z.
+
+        Solves the normal equations if Z^T Z is well-conditioned, and otherwise
+        returns the minimum-norm solution of np.linalg.lstsq with rcond=None.
+
+        Parameters
+        ----------
+        z, vals : arrays
+            Data arrays of shape (T, dim_z) and (T, dim).
+
+        Returns
+        -------
+        beta_hat : array
+            Coefficients of shape (dim_z, dim).
+        """
+        gram_z = np.dot(z.T, z)
+        if np.linalg.cond(gram_z) < _MAX_COND_NORMAL_EQUATIONS:
+            try:
+                return linalg.solve(gram_z, np.dot(z.T, vals), assume_a='pos', check_finite=False)
+            except linalg.LinAlgError:
+                pass
+        return linalg.lstsq(z, vals, cond=_EPS * max(z.shape),
+                            lapack_driver='gelsd', check_finite=False)[0]
+
+    def _get_parcorr_min_pvalue(self, value, deg_f):
+        """Returns the minimum analytic p-value of partial correlations.
+
+        For given degrees of freedom, the p-value decreases with the absolute partial
+        correlation, hence only the largest absolute partial correlation for each
+        number of degrees of freedom is transformed.
+
+        Parameters
+        ----------
+        value : array
+            Partial correlations.
+
+        deg_f : array of ints
+            Degrees of freedom of the same shape.
+
+        Returns
+        -------
+        pval : float or numpy.nan
+            Minimum p-value, nan if any p-value is nan.
+        """
+        deg_f_unique, inverse = np.unique(deg_f, return_inverse=True)
+        value_max = np.full(len(deg_f_unique), -np.inf)
+        np.maximum.at(value_max, inverse, np.abs(value))
+        return np.min(self._get_parcorr_pvalues(value_max, deg_f_unique))
+
+    def _get_parcorr_pvalues(self, value, deg_f):
+        """Returns analytic p-values of partial correlations, vectorized version of
+        ParCorr.get_analytic_significance.
+
+        Parameters
+        ----------
+        value : array-like
+            Partial correlations.
+
+        deg_f : int or array-like
+            Degrees of freedom, broadcastable to value.
+
+        Returns
+        -------
+        pval : array
+            P-values, numpy.nan where the degrees of freedom are less than 1.
+        """
+        value = np.asarray(value, dtype='float')
+        deg_f = np.broadcast_to(deg_f, value.shape)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            trafo_val = value * np.sqrt(deg_f/(1. - value*value))
+            pval = stats.t.sf(np.abs(trafo_val), deg_f) * 2
+        pval = np.where(np.abs(np.abs(value) - 1.0) <= sys.float_info.min, 0., pval)
+        pval = np.where(deg_f < 1, np.nan, pval)
+
+        return pval
+
+    def _get_cond_cholesky(self, gram, indices):
+        """Returns the Cholesky factor of the Gram matrix of the additional conditions.
+
+        The factor only depends on the set of conditions, which is shared by many pairs
+        (j, jj) in the second step. It is therefore cached per call of
+        calculate_dep_measure_and_significance.
+
+        Parameters
+        ----------
+        gram : array
+            Inner products of the residuals w.r.t. Z of all X and Y components.
+
+        indices : array of ints
+            Components that are used as additional conditions.
+
+        Returns
+        -------
+        cholesky : array or None
+            Lower triangular factor, None if the conditions are (nearly) collinear.
+        """
+        key = ("cholesky", frozenset(indices.tolist()))
+        if key not in self._cache:
+            try:
+                cholesky = np.linalg.cholesky(gram[np.ix_(indices, indices)])
+                # The squared diagonal holds the residual variances of the (normalized)
+                # conditions given the preceding ones, if these are tiny, the Schur
+                # complements below lose too much precision
+                if np.diag(cholesky).min()**2 <= 1e-8:
+                    cholesky = None
+            except np.linalg.LinAlgError:
+                cholesky = None
+            self._cache[key] = cholesky
+        return self._cache[key]
+
+    def _get_cond_basis(self, resid, indices):
+        """Returns an orthonormal basis of the residuals of the additional conditions.
+
+        Cached as in _get_cond_cholesky.
+
+        Parameters
+        ----------
+        resid : array
+            Residuals w.r.t. Z of all X and Y components.
+
+        indices : array of ints
+            Components that are used as additional conditions.
+
+        Returns
+        -------
+        basis : array
+            Orthonormal basis of shape (T, rank) of the span of resid[:, indices].
+        """
+        key = ("basis", frozenset(indices.tolist()))
+        if key not in self._cache:
+            # Residuals of constant components are nan and do not contribute to the span.
+            # Rank-revealing as in np.linalg.lstsq with rcond=None
+            u, s, _ = np.linalg.svd(np.nan_to_num(resid[:, indices]), full_matrices=False)
+            tol = s.max() * max(resid.shape[0], len(indices)) * np.finfo(float).eps
+            self._cache[key] = u[:, s > tol]
+        return self._cache[key]
+
+    def _get_parcorr_main(self, resid, gram, a, b, indices):
+        """Returns the partial correlation of a single test of the second step.
+
+        Parameters
+        ----------
+        resid : array
+            Normalized residuals w.r.t. Z of all X and Y components.
+
+        gram : array
+            Inner products of resid.
+
+        a, b : int
+            Tested components.
+
+        indices : array of ints
+            Components that are used as additional conditions.
+
+        Returns
+        -------
+        val : float
+            Partial correlation.
+        """
+        if len(indices) == 0:
+            return gram[a, b]
+
+        cholesky = self._get_cond_cholesky(gram, indices)
+        if cholesky is not None:
+            # Frisch-Waugh-Lovell: the inner products of the residuals w.r.t. (Z, S_ij)
+            # are the Schur complement of the conditions in the Gram matrix
+            w = linalg.solve_triangular(cholesky, gram[np.ix_(indices, [a, b])], lower=True,
+                                        check_finite=False)
+            cov = gram[np.ix_([a, b], [a, b])] - np.dot(w.T, w)
+        if cholesky is None or min(cov[0, 0], cov[1, 1]) <= 1e-8:
+            # Otherwise project the residuals onto the complement of the conditions
+            basis = self._get_cond_basis(resid, indices)
+            xy_resid = resid[:, [a, b]]
+            xy_resid = xy_resid - np.dot(basis, np.dot(basis.T, xy_resid))
+            cov = np.dot(xy_resid.T, xy_resid)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return cov[0, 1] / np.sqrt(cov[0, 0] * cov[1, 1])
+
+    def _get_array_hash(self, array, xyz, XYZ):
+        """Helper function to get hash of array, see CondIndTest._get_array_hash.
+
+        With early stopping, the results cached by run_test depend on alpha_or_thres,
+        which is then part of the hash.
+        """
+        combined_hash = CondIndTest._get_array_hash(self, array, xyz, XYZ)
+        if self.early_stop:
+            return combined_hash + (self._alpha_or_thres,)
+        return combined_hash
+
+    def run_test(self, X, Y, Z=None, tau_max=0, cut_off='2xtau_max', alpha_or_thres=None):
+        """Perform conditional independence test, see CondIndTest.run_test.
+
+        Keeps alpha_or_thres for the early stopping of the second step.
+        """
+        self._alpha_or_thres = alpha_or_thres
+        try:
+            return CondIndTest.run_test(self, X=X, Y=Y, Z=Z, tau_max=tau_max, cut_off=cut_off,
+                                        alpha_or_thres=alpha_or_thres)
+        finally:
+            self._alpha_or_thres = None
+
+    def run_test_raw(self, x, y, z=None, x_type=None, y_type=None, z_type=None, alpha_or_thres=None):
+        """Perform conditional independence test directly on input arrays,
+        see CondIndTest.run_test_raw.
+
+        Keeps alpha_or_thres for the early stopping of the second step, and reuses
+        the results of the first step of previous tests on the same data.
+        """
+        self._alpha_or_thres = alpha_or_thres
+        self._use_pre_cache = True
+        try:
+            return CondIndTest.run_test_raw(self, x=x, y=y, z=z, x_type=x_type, y_type=y_type,
+                                            z_type=z_type, alpha_or_thres=alpha_or_thres)
+        finally:
+            self._alpha_or_thres = None
+            self._use_pre_cache = False
 
     def get_dependence_measure(self, array, xyz, data_type=None, ci_test_thres = None):
 